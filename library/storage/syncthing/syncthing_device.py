@@ -25,36 +25,75 @@ description:
 options:
     id:
         description:
-            - This is the unique id of this new device
-        required: true
+            - This is the unique id of this new device.
+              Required unless `devices` is provided.
+        required: false
     name:
         description:
             - The name for this new device
         required: false
+    devices:
+        description:
+            - List of devices to manage at once, each with its own `id`,
+              `name` and `state`. All of them are applied with a single
+              update of the Syncthing configuration.
+              Mutually exclusive with `id`.
+        required: false
     host:
         description:
-            - Host to connect to, including port
+            - Host to connect to, including port.
+              If not provided, taken from the SYNCTHING_HOST environment
+              variable when set.
         default: http://127.0.0.1:8384
     api_key:
         description:
             - API key to use for authentication with host.
-              If not provided, will try to auto-configure from filesystem.
+              If not provided, taken from the SYNCTHING_API_KEY environment
+              variable when set, else will try to auto-configure from
+              filesystem.
         required: false
     config_file:
         description:
             - Path to the Syncthing configuration file for automatic
               discovery (`api_key`). Note that the running user needs read
               access to the file.
+              Defaults to the first one found of the default locations of
+              the platform (on Linux, `~/.config/syncthing/config.xml` then
+              `~/.local/state/syncthing/config.xml`, honouring
+              `XDG_CONFIG_HOME` and `XDG_STATE_HOME`).
         required: false
     timeout:
         description:
             - The socket level timeout in seconds
         default: 30
+    cache_ttl:
+        description:
+            - Number of seconds the Syncthing configuration fetched by a
+              task can be reused by the following tasks targeting the same
+              host, instead of fetching it again. The cache is kept under
+              `~/.cache/ansible_syncthing` of the running user. The cached
+              configuration is also dropped as soon as Syncthing rewrites its
+              config.xml (see `config_file`), when it can be read. Otherwise,
+              changes made to the configuration by other means than these
+              modules in the meantime are overwritten, so only enable it when
+              nothing else manages this Syncthing instance.
+              The API key auto-configured from config.xml is cached there
+              as well, until the file changes.
+              Defaults to 0, disabling the cache.
+        default: 0
     state:
         description:
             - Use present/absent to ensure device is added, or not.
         default: present
-        choices: ['absent', 'present', 'paused']
+        choices: ['absent', 'present', 'pause']
+
+notes:
+    - When the python `requests` library is available on the managed host,
+      all the calls to the Syncthing API made by a task share a single
+      keep-alive connection, and calls failing to connect are retried
+      twice, GETs being also retried on read failures. This is not the
+      case when any of `url_username`, `url_password`, `force_basic_auth`,
+      `client_cert`, `client_key` or `use_gssapi` is used.
 
 author:
     - Rafael Bodill (@rafi)
@@ -66,6 +105,15 @@ EXAMPLES = '''
   syncthing_device:
     id: 1234-1234-1234-1234
     name: my-server-name
+
+# Add several devices at once
+- name: Add syncthing devices
+  syncthing_device:
+    devices:
+      - id: 1234-1234-1234-1234
+        name: my-server-name
+      - id: 5678-5678-5678-5678
+        name: my-other-server-name
 '''
 
 RETURN = '''
@@ -74,114 +122,100 @@ response:
     type: dict
 '''
 
-import os
-import json
-import platform
-from xml.etree.ElementTree import parse
+from collections import OrderedDict
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.urls import fetch_url, url_argument_spec
-
-SYNCTHING_API_URI = "/rest/system/config"
-if platform.system() == 'Windows':
-    DEFAULT_ST_CONFIG_LOCATION = '%localappdata%/Syncthing/config.xml'
-elif platform.system() == 'Darwin':
-    DEFAULT_ST_CONFIG_LOCATION = '$HOME/Library/Application Support/Syncthing/config.xml'
-else:
-    DEFAULT_ST_CONFIG_LOCATION = '$HOME/.config/syncthing/config.xml'
-
-
-def make_headers(host, api_key):
-    url = '{}{}'.format(host, SYNCTHING_API_URI)
-    headers = {'X-Api-Key': api_key }
-    return url, headers
-
-def get_key_from_filesystem(module):
-    try:
-        if module.params['config_file']:
-            stconfigfile = module.params['config_file']
-        else:
-            stconfigfile = os.path.expandvars(DEFAULT_ST_CONFIG_LOCATION)
-        stconfig = parse(stconfigfile)
-        root = stconfig.getroot()
-        gui = root.find('gui')
-        api_key = gui.find('apikey').text
-        return api_key
-    except Exception:
-        module.fail_json(msg="Auto-configuration failed. Please specify"
-                             "the API key manually.")
-
-# Fetch Syncthing configuration
-def get_config(module):
-    url, headers = make_headers(module.params['host'], module.params['api_key'])
-    resp, info = fetch_url(
-        module, url, data=None, headers=headers,
-        method='GET', timeout=module.params['timeout'])
-
-    if not info or info['status'] != 200:
-        result['response'] = info
-        module.fail_json(msg='Error occured while calling host', **result)
-
-    try:
-        content = resp.read()
-    except AttributeError:
-        result['content'] = info.pop('body', '')
-        result['response'] = str(info)
-        module.fail_json(msg='Error occured while reading response', **result)
-
-    return json.loads(content)
-
-# Post the new configuration to Syncthing API
-def post_config(module, config, result):
-    url, headers = make_headers(module.params['host'], module.params['api_key'])
-    headers['Content-Type'] = 'application/json'
-
-    result['msg'] = config
-    resp, info = fetch_url(
-        module, url, data=json.dumps(config), headers=headers,
-        method='POST', timeout=module.params['timeout'])
-
-    if not info or info['status'] != 200:
-        result['response'] = str(info)
-        module.fail_json(msg='Error occured while posting new config', **result)
+from ansible.module_utils.syncthing import (
+    get_common_argument_spec,
+    get_key_from_filesystem,
+    get_config,
+    post_config,
+)
+
+
+# Device arguments, either at the top-level or for each of `devices`
+_DEVICE_ARGS = dict(
+    id=dict(type='str', required=True),
+    name=dict(type='str', required=False),
+    state=dict(type='str', default='present',
+               choices=['absent', 'present', 'pause']),
+)
+
+# Module arguments, built once when the module is imported
+_ARG_SPEC = get_common_argument_spec()
+_ARG_SPEC.update(_DEVICE_ARGS)
+_ARG_SPEC.update(dict(
+    id=dict(type='str', required=False),
+    devices=dict(type='list', elements='dict', required=False,
+                 options=_DEVICE_ARGS),
+))
+
+# Get the device ID -> device mapping of the configured devices, in order.
+def get_devices_by_id(config):
+    return OrderedDict((d['deviceID'], d) for d in config['devices'])
+
+# The settings of a new device which do not depend on the module parameters.
+# Built once and shallow-copied: nested values are shared, never mutate them.
+_DEVICE_TEMPLATE = {
+    'addresses': [
+        'dynamic'
+    ],
+    'allowedNetworks': [],
+    'autoAcceptFolders': False,
+    'certName': '',
+    'compression': 'metadata',
+    'ignoredFolders': [],
+    'introducedBy': '',
+    'introducer': False,
+    'maxRecvKbps': 0,
+    'maxSendKbps': 0,
+    'pendingFolders': [],
+    'skipIntroductionRemovals': False
+}
 
 # Returns an object of a new device
 def create_device(params):
-    device = {
-        'addresses': [
-            'dynamic'
-        ],
-        'allowedNetworks': [],
-        'autoAcceptFolders': False,
-        'certName': '',
-        'compression': 'metadata',
+    device = _DEVICE_TEMPLATE.copy()
+    device.update({
         'deviceID': params['id'],
-        'ignoredFolders': [],
-        'introducedBy': '',
-        'introducer': False,
-        'maxRecvKbps': 0,
-        'maxSendKbps': 0,
         'name': params['name'],
-        'paused': True if params['state'] == 'paused' else False,
-        'pendingFolders': [],
-        'skipIntroductionRemovals': False
-    }
+        'paused': params['state'] == 'pause',
+    })
     return device
 
-def run_module():
-    # module arguments
-    module_args = url_argument_spec()
-    module_args.update(dict(
-        id=dict(type='str', required=True),
-        name=dict(type='str', required=False),
-        host=dict(type='str', default='http://127.0.0.1:8384'),
-        api_key=dict(type='str', required=False, no_log=True),
-        config_file=dict(type='str', required=False),
-        timeout=dict(type='int', default=30),
-        state=dict(type='str', default='present',
-                   choices=['absent', 'present', 'pause']),
-    ))
+# Apply the wanted state of a single device to the configuration.
+# Returns whether the configuration was changed, recording the change into
+# `diff` if given.
+def update_device(devices_by_id, params, diff=None):
+    if params['state'] == 'absent':
+        # Remove device from list, if found
+        device = devices_by_id.pop(params['id'], None)
+        if device is None:
+            return False
+        if diff is not None:
+            diff['before'][params['id']] = device
+        return True
+
+    device = devices_by_id.get(params['id'])
+    if device is not None:
+        # Bail-out if device is already added
+        want_pause = params['state'] == 'pause'
+        if device['paused'] == want_pause:
+            return False
+        if diff is not None:
+            diff['before'][params['id']] = dict(device)
+            diff['after'][params['id']] = device
+        device['paused'] = want_pause
+        return True
+
+    # Append the new device into configuration
+    device = create_device(params)
+    devices_by_id[params['id']] = device
+    if diff is not None:
+        diff['after'][params['id']] = device
+    return True
 
+def run_module():
     # seed the result dict in the object
     result = {
         "changed": False,
@@ -190,12 +224,22 @@ def run_module():
 
     # the AnsibleModule object will be our abstraction working with Ansible
     module = AnsibleModule(
-        argument_spec=module_args,
+        argument_spec=_ARG_SPEC,
+        mutually_exclusive=[('id', 'devices')],
+        required_one_of=[('id', 'devices')],
         supports_check_mode=True
     )
 
-    if module.params['state'] != 'absent' and not module.params['name']:
-        module.fail_json(msg='You must provide a name when creating', **result)
+    # Either a batch of devices, or the single one given at the top-level
+    if module.params['devices'] is not None:
+        devices = module.params['devices']
+    else:
+        devices = [module.params]
+
+    for params in devices:
+        if params['state'] != 'absent' and not params['name']:
+            module.fail_json(msg='You must provide a name when creating',
+                             **result)
 
     if module.check_mode:
         return result
@@ -205,33 +249,17 @@ def run_module():
         module.params['api_key'] = get_key_from_filesystem(module)
 
     config = get_config(module)
-    if module.params['state'] == 'absent':
-        # Remove device from list, if found
-        for idx, device in enumerate(config['devices']):
-            if device['deviceID'] == module.params['id']:
-                config['devices'].pop(idx)
-                result['changed'] = True
-                break
-    else:
-        # Bail-out if device is already added
-        for device in config['devices']:
-            if device['deviceID'] == module.params['id']:
-                want_pause = module.params['state'] == 'pause'
-                if (want_pause and device['paused']) or \
-                        (not want_pause and not device['paused']):
-                    module.exit_json(**result)
-                else:
-                    device['paused'] = want_pause
-                    result['changed'] = True
-                    break
-
-        # Append the new device into configuration
-        if not result['changed']:
-            device = create_device(module.params)
-            config['devices'].append(device)
+    devices_by_id = get_devices_by_id(config)
+    # The changed devices by ID, only tracked when asked for a diff
+    diff = {'before': {}, 'after': {}} if module._diff else None
+    for params in devices:
+        if update_device(devices_by_id, params, diff):
             result['changed'] = True
 
     if result['changed']:
+        config['devices'] = list(devices_by_id.values())
+        if diff is not None:
+            result['diff'] = diff
         post_config(module, config, result)
 
     module.exit_json(**result)
@@ -25,8 +25,9 @@ description:
 options:
     id:
         description:
-            - This is the unique id of this new folder
-        required: true
+            - This is the unique id of this new folder.
+              Required unless `folders` is provided.
+        required: false
     label:
         description:
             - The label for this new folder
@@ -53,30 +54,70 @@ options:
               remote changes.
         default: sendreceive
         choices: ['sendreceive', 'sendonly', 'receiveonly']
+    folders:
+        description:
+            - List of folders to manage at once, each accepting the same
+              folder options as above (`id`, `label`, `path`, `devices`,
+              `fs_watcher`, `ignore_perms`, `type` and `state`). All of them
+              are applied with a single update of the Syncthing configuration.
+              Mutually exclusive with `id`.
+        required: false
     host:
         description:
-            - Host to connect to, including port
+            - Host to connect to, including port.
+              If not provided, taken from the SYNCTHING_HOST environment
+              variable when set.
         default: http://127.0.0.1:8384
     api_key:
         description:
             - API key to use for authentication with host.
-              If not provided, will try to auto-configure from filesystem.
+              If not provided, taken from the SYNCTHING_API_KEY environment
+              variable when set, else will try to auto-configure from
+              filesystem.
         required: false
     config_file:
         description:
             - Path to the Syncthing configuration file for automatic
               discovery (`api_key`). Note that the running user needs read
               access to the file.
+              Defaults to the first one found of the default locations of
+              the platform (on Linux, `~/.config/syncthing/config.xml` then
+              `~/.local/state/syncthing/config.xml`, honouring
+              `XDG_CONFIG_HOME` and `XDG_STATE_HOME`).
         required: false
     timeout:
         description:
             - The socket level timeout in seconds
         default: 30
+    cache_ttl:
+        description:
+            - Number of seconds the Syncthing configuration and device ID
+              fetched by a task can be reused by the following tasks
+              targeting the same host, instead of fetching them again. The
+              cache is kept under `~/.cache/ansible_syncthing` of the running
+              user. The cached configuration is also dropped as soon as
+              Syncthing rewrites its config.xml (see `config_file`), when it
+              can be read. Otherwise, changes made to the configuration by
+              other means than these modules in the meantime are overwritten,
+              so only enable it when nothing else manages this Syncthing
+              instance.
+              The API key auto-configured from config.xml is cached there
+              as well, until the file changes.
+              Defaults to 0, disabling the cache.
+        default: 0
     state:
         description:
             - Use present/absent to ensure folder is shared, or not.
         default: present
-        choices: ['absent', 'present', 'paused']
+        choices: ['absent', 'present', 'pause']
+
+notes:
+    - When the python `requests` library is available on the managed host,
+      all the calls to the Syncthing API made by a task share a single
+      keep-alive connection, and calls failing to connect are retried
+      twice, GETs being also retried on read failures. This is not the
+      case when any of `url_username`, `url_password`, `force_basic_auth`,
+      `client_cert`, `client_key` or `use_gssapi` is used.
 
 author:
     - Rafael Bodill (@rafi)
@@ -90,6 +131,19 @@ EXAMPLES = '''
     path: ~/box
     devices:
       - 1234-1234-1234-1234
+
+# Add several folders at once
+- name: Add syncthing folders
+  syncthing_folder:
+    folders:
+      - id: box
+        path: ~/box
+        devices:
+          - 1234-1234-1234-1234
+      - id: music
+        path: ~/music
+        devices:
+          - 1234-1234-1234-1234
 '''
 
 RETURN = '''
@@ -98,76 +152,43 @@ response:
     type: dict
 '''
 
-import os
-import json
-import platform
-from xml.etree.ElementTree import parse
+from collections import OrderedDict
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.urls import fetch_url, url_argument_spec
-
-SYNCTHING_API_BASE_URI = "/rest"
-if platform.system() == 'Windows':
-    DEFAULT_ST_CONFIG_LOCATION = '%localappdata%/Syncthing/config.xml'
-elif platform.system() == 'Darwin':
-    DEFAULT_ST_CONFIG_LOCATION = '$HOME/Library/Application Support/Syncthing/config.xml'
-else:
-    DEFAULT_ST_CONFIG_LOCATION = '$HOME/.config/syncthing/config.xml'
-
-
-def make_headers(host, api_key, resource):
-    url = '{}{}/{}'.format(host, SYNCTHING_API_BASE_URI, resource)
-    headers = {'X-Api-Key': api_key }
-    return url, headers
-
-def get_key_from_filesystem(module):
-    try:
-        if module.params['config_file']:
-            stconfigfile = module.params['config_file']
-        else:
-            stconfigfile = os.path.expandvars(DEFAULT_ST_CONFIG_LOCATION)
-        stconfig = parse(stconfigfile)
-        root = stconfig.getroot()
-        gui = root.find('gui')
-        api_key = gui.find('apikey').text
-        return api_key
-    except Exception:
-        module.fail_json(msg="Auto-configuration failed. Please specify"
-                             "the API key manually.")
-
-def get_data_from_rest_api(module, resource):
-    url, headers = make_headers(
-        module.params['host'], module.params['api_key'], resource
-    )
-    resp, info = fetch_url(
-        module,
-        url,
-        data=None,
-        headers=headers,
-        method='GET',
-        timeout=module.params['timeout']
-    )
-
-    if not info or info['status'] != 200:
-        result['response'] = info
-        module.fail_json(msg='Error occured while calling host', **result)
-
-    try:
-        content = resp.read()
-    except AttributeError:
-        result['content'] = info.pop('body', '')
-        result['response'] = str(info)
-        module.fail_json(msg='Error occured while reading response', **result)
-
-    return json.loads(content)
-
-# Fetch Syncthing configuration
-def get_config(module):
-    return get_data_from_rest_api(module, 'system/config')
-
-# Fetch Syncthing status
-def get_status(module):
-    return get_data_from_rest_api(module, 'system/status')
+from ansible.module_utils.syncthing import (
+    get_common_argument_spec,
+    get_key_from_filesystem,
+    get_config,
+    get_self_id,
+    post_config,
+)
+
+# Device IDs are 8 groups of 7 characters, separated by dashes
+DEVICE_ID_LENGTH = 63
+
+
+# Folder arguments, either at the top-level or for each of `folders`
+_FOLDER_ARGS = dict(
+    id=dict(type='str', required=True),
+    label=dict(type='str', required=False),
+    path=dict(type='path', required=False),
+    devices=dict(type='list', elements='str', required=False, default=[]),
+    fs_watcher=dict(type='bool', default=True),
+    ignore_perms=dict(type='bool', required=False, default=False),
+    type=dict(type='str', default='sendreceive',
+        choices=['sendreceive', 'sendonly', 'receiveonly']),
+    state=dict(type='str', default='present',
+               choices=['absent', 'present', 'pause']),
+)
+
+# Module arguments, built once when the module is imported
+_ARG_SPEC = get_common_argument_spec()
+_ARG_SPEC.update(_FOLDER_ARGS)
+_ARG_SPEC.update(dict(
+    id=dict(type='str', required=False),
+    folders=dict(type='list', elements='dict', required=False,
+                 options=_FOLDER_ARGS),
+))
 
 # Get the device name -> device ID mapping.
 def get_devices_mapping(config):
@@ -175,117 +196,171 @@ def get_devices_mapping(config):
         device['name']: device['deviceID'] for device in config['devices']
     }
 
-# Get the folder configuration from the global configuration, if it exists
-def get_folder_config(folder_id, config):
-    for folder in config['folders']:
-        if folder['id'] == folder_id:
-            return folder
-    return None
-
-# Post the new configuration to Syncthing API
-def post_config(module, config, result):
-    url, headers = make_headers(
-        module.params['host'],
-        module.params['api_key'],
-        'system/config',
-    )
-    headers['Content-Type'] = 'application/json'
-
-    result['msg'] = config
-    resp, info = fetch_url(
-        module, url, data=json.dumps(config), headers=headers,
-        method='POST', timeout=module.params['timeout'])
-
-    if not info or info['status'] != 200:
-        result['response'] = str(info)
-        module.fail_json(**result)
+# Get the folder ID -> folder mapping of the configured folders, in order.
+def get_folders_by_id(config):
+    return OrderedDict((f['id'], f) for f in config['folders'])
+
+# The settings of a new folder which do not depend on the module parameters.
+# Built once and shallow-copied: nested values are shared, never mutate them.
+_FOLDER_TEMPLATE = {
+    'autoNormalize': True,
+    'copiers': 0,
+    'disableSparseFiles': False,
+    'disableTempIndexes': False,
+    'filesystemType': 'basic',
+    'fsWatcherDelayS': 10,
+    'hashers': 0,
+    'ignoreDelete': False,
+    'markerName': '.stfolder',
+    'maxConflicts': -1,
+    'minDiskFree': {
+        'unit': '%',
+        'value': 1
+    },
+    'order': 'random',
+    'pullerMaxPendingKiB': 0,
+    'pullerPauseS': 0,
+    'rescanIntervalS': 3600,
+    'scanProgressIntervalS': 0,
+    'useLargeBlocks': False,
+    'versioning': {
+        'params': {},
+        'type': ''
+    },
+    'weakHashThresholdPct': 25
+}
 
-# Returns an object of a new folder
-def create_folder(params, self_id, current_device_ids, devices_mapping):
+# Get the IDs of the devices the folder should be shared with
+def get_wanted_device_ids(params, self_id, devices_mapping, known_device_ids):
     # We need the current device ID as per the Syncthing API.
     # If missing, Syncthing will add it alright, but we don't want to give
     # the false idea that this configuration is different just because of that.
-    wanted_device_ids = {self_id}
-    for device_name_or_id in params['devices']:
-        if device_name_or_id in devices_mapping:
-            wanted_device_ids.add(devices_mapping[device_name_or_id])
-        else:
-            # Purposefully do not validate we already know this device ID or
-            # name as per previous behavior.  This will need to be fixed.
-            wanted_device_ids.add(device_name_or_id)
+    wanted_device_ids = set([self_id])
+    wanted_device_ids.update(
+        get_device_id(device_name_or_id, devices_mapping, known_device_ids)
+        for device_name_or_id in params['devices']
+    )
+    return wanted_device_ids
+
+# Get the ID of a device given either by name or by ID
+def get_device_id(device_name_or_id, devices_mapping, known_device_ids):
+    # Only what looks like a device ID can be one, spare the other lookups
+    if len(device_name_or_id) == DEVICE_ID_LENGTH and \
+            device_name_or_id in known_device_ids:
+        return device_name_or_id
+    # Purposefully do not validate we already know this device ID or
+    # name as per previous behavior.  This will need to be fixed.
+    return devices_mapping.get(device_name_or_id, device_name_or_id)
+
+# Get the folder settings controlled by the module parameters, but the devices
+def get_folder_settings(params):
+    return {
+        'fsWatcherEnabled': params['fs_watcher'],
+        'id': params['id'],
+        'ignorePerms': params['ignore_perms'],
+        'label': params['label'] or params['id'],
+        'path': params['path'],
+        'paused': params['state'] == 'pause',
+        'type': params['type'],
+    }
 
+# Whether the folder configuration already has the wanted settings and devices.
+# Only these are compared: the other settings are not managed by this module.
+def is_folder_up_to_date(folder_config, settings, current_device_id_set,
+                         wanted_device_ids):
+    for key, value in settings.items():
+        if folder_config.get(key) != value:
+            return False
+    return current_device_id_set == wanted_device_ids
+
+# Sorted device IDs, by frozenset of device IDs
+_SORTED_DEVICE_IDS = {}
+
+# Sort the given device IDs, remembering the result: batches of folders are
+# usually shared with the same devices
+def sort_device_ids(device_ids):
+    sorted_ids = _SORTED_DEVICE_IDS.get(device_ids)
+    if sorted_ids is None:
+        sorted_ids = _SORTED_DEVICE_IDS[device_ids] = tuple(sorted(device_ids))
+    return sorted_ids
+
+# Returns an object of the wanted folder: based on the existing one if any,
+# keeping the settings this module does not manage, else on the template
+def create_folder(settings, wanted_device_ids, current_device_ids,
+                  current_device_id_set, folder_config=None):
     # Keep the original ordering if collections are equivalent.
     # Again, for idempotency reasons.
     device_ids = (
         current_device_ids
-        if set(current_device_ids) == wanted_device_ids
-        else sorted(wanted_device_ids)
+        if current_device_id_set == wanted_device_ids
+        else sort_device_ids(frozenset(wanted_device_ids))
     )
 
+    # Keep the entries of the devices the folder is already shared with
+    current_devices = (
+        dict((d['deviceID'], d) for d in folder_config['devices'])
+        if folder_config is not None else {}
+    )
     # Sort the device IDs to keep idem-potency
     devices = [
-        {
+        current_devices.get(device_id) or {
             'deviceID': device_id,
             'introducedBy': '',
         } for device_id in device_ids
     ]
 
-    return {
-        'autoNormalize': True,
-        'copiers': 0,
-        'devices': devices,
-        'disableSparseFiles': False,
-        'disableTempIndexes': False,
-        'filesystemType': 'basic',
-        'fsWatcherDelayS': 10,
-        'fsWatcherEnabled': params['fs_watcher'],
-        'hashers': 0,
-        'id': params['id'],
-        'ignoreDelete': False,
-        'ignorePerms': params['ignore_perms'],
-        'label': params['label'] if params['label'] else params['id'],
-        'markerName': '.stfolder',
-        'maxConflicts': -1,
-        'minDiskFree': {
-            'unit': '%',
-            'value': 1
-        },
-        'order': 'random',
-        'path': params['path'],
-        'paused': True if params['state'] == 'paused' else False,
-        'pullerMaxPendingKiB': 0,
-        'pullerPauseS': 0,
-        'rescanIntervalS': 3600,
-        'scanProgressIntervalS': 0,
-        'type': params['type'],
-        'useLargeBlocks': False,
-        'versioning': {
-            'params': {},
-            'type': ''
-        },
-        'weakHashThresholdPct': 25
-    }
+    if folder_config is not None:
+        folder = dict(folder_config)
+    else:
+        folder = _FOLDER_TEMPLATE.copy()
+    folder.update(settings)
+    folder['devices'] = devices
+    return folder
+
+# Apply the wanted state of a single folder to the configuration.
+# Returns whether the configuration was changed, recording the change into
+# `diff` if given.
+def update_folder(folders_by_id, params, self_id, devices_mapping,
+                  known_device_ids, diff=None):
+    if params['state'] == 'absent':
+        # Remove folder from list, if found
+        folder = folders_by_id.pop(params['id'], None)
+        if folder is None:
+            return False
+        if diff is not None:
+            diff['before'][params['id']] = folder
+        return True
+
+    folder_config = folders_by_id.get(params['id'])
+    folder_config_devices = (
+        tuple(d['deviceID'] for d in folder_config['devices'])
+        if folder_config else ()
+    )
+    folder_config_device_set = frozenset(folder_config_devices)
+    settings = get_folder_settings(params)
+    wanted_device_ids = get_wanted_device_ids(
+        params, self_id, devices_mapping, known_device_ids
+    )
+    # Bail-out before building the whole folder if it is already up-to-date
+    if folder_config is not None and is_folder_up_to_date(
+            folder_config, settings, folder_config_device_set,
+            wanted_device_ids):
+        return False
+
+    folder_config_wanted = create_folder(
+        settings, wanted_device_ids, folder_config_devices,
+        folder_config_device_set, folder_config
+    )
 
-def run_module():
-    # module arguments
-    module_args = url_argument_spec()
-    module_args.update(dict(
-        id=dict(type='str', required=True),
-        label=dict(type='str', required=False),
-        path=dict(type='path', required=False),
-        devices=dict(type='list', required=False, default=False),
-        fs_watcher=dict(type='bool', default=True),
-        ignore_perms=dict(type='bool', required=False, default=False),
-        type=dict(type='str', default='sendreceive',
-            choices=['sendreceive', 'sendonly', 'receiveonly']),
-        host=dict(type='str', default='http://127.0.0.1:8384'),
-        api_key=dict(type='str', required=False, no_log=True),
-        config_file=dict(type='path', required=False),
-        timeout=dict(type='int', default=30),
-        state=dict(type='str', default='present',
-                   choices=['absent', 'present', 'pause']),
-    ))
+    # Add the folder, or replace it keeping its position
+    folders_by_id[params['id']] = folder_config_wanted
+    if diff is not None:
+        if folder_config is not None:
+            diff['before'][params['id']] = folder_config
+        diff['after'][params['id']] = folder_config_wanted
+    return True
 
+def run_module():
     # seed the result dict in the object
     result = {
         "changed": False,
@@ -294,12 +369,22 @@ def run_module():
 
     # the AnsibleModule object will be our abstraction working with Ansible
     module = AnsibleModule(
-        argument_spec=module_args,
+        argument_spec=_ARG_SPEC,
+        mutually_exclusive=[('id', 'folders')],
+        required_one_of=[('id', 'folders')],
         supports_check_mode=True
     )
 
-    if module.params['state'] != 'absent' and not module.params['path']:
-        module.fail_json(msg='You must provide a path when creating', **result)
+    # Either a batch of folders, or the single one given at the top-level
+    if module.params['folders'] is not None:
+        folders = module.params['folders']
+    else:
+        folders = [module.params]
+
+    for params in folders:
+        if params['state'] != 'absent' and not params['path']:
+            module.fail_json(msg='You must provide a path when creating',
+                             **result)
 
     if module.check_mode:
         return result
@@ -309,34 +394,21 @@ def run_module():
         module.params['api_key'] = get_key_from_filesystem(module)
 
     config = get_config(module)
-    self_id = get_status(module)['myID']
+    self_id = get_self_id(module)
     devices_mapping = get_devices_mapping(config)
-    if module.params['state'] == 'absent':
-        # Remove folder from list, if found
-        for idx, folder in enumerate(config['folders']):
-            if folder['id'] == module.params['id']:
-                config['folders'].pop(idx)
-                result['changed'] = True
-                break
-    else:
-        folder_config = get_folder_config(module.params['id'], config)
-        folder_config_devices = (
-            [d['deviceID'] for d in folder_config['devices']] if folder_config else []
-        )
-        folder_config_wanted = create_folder(
-            module.params, self_id, folder_config_devices, devices_mapping
-        )
-
-        if folder_config is None:
-            config['folders'].append(folder_config_wanted)
-            result['changed'] = True
-        elif folder_config != folder_config_wanted:
-            # Update the folder configuration in-place
-            folder_config.clear()
-            folder_config.update(folder_config_wanted)
+    known_device_ids = frozenset(devices_mapping.values())
+    folders_by_id = get_folders_by_id(config)
+    # The changed folders by ID, only tracked when asked for a diff
+    diff = {'before': {}, 'after': {}} if module._diff else None
+    for params in folders:
+        if update_folder(folders_by_id, params, self_id, devices_mapping,
+                         known_device_ids, diff):
             result['changed'] = True
 
     if result['changed']:
+        config['folders'] = list(folders_by_id.values())
+        if diff is not None:
+            result['diff'] = diff
         post_config(module, config, result)
 
     module.exit_json(**result)
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2018, Rafael Bodill <justrafi at gmail>
+# Copyright: (c) 2020, Borjan Tchakaloff <first name at last name dot fr>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Helpers shared by the Syncthing modules, to talk to the Syncthing REST API.
+
+import os
+import json
+import time
+import hashlib
+import platform
+import tempfile
+try:
+    from lxml.etree import iterparse, ParseError
+except ImportError:
+    try:
+        from xml.etree.cElementTree import iterparse, ParseError
+    except ImportError:
+        from xml.etree.ElementTree import iterparse, ParseError
+
+from io import BytesIO
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+# (De)serialize JSON from/to bytes, with the faster orjson when available
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj)
+
+    def _loads(data):
+        return orjson.loads(data)
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _loads(data):
+        return json.loads(data.decode('utf-8'))
+
+from ansible.module_utils.basic import env_fallback
+from ansible.module_utils.urls import fetch_url, url_argument_spec
+
+__all__ = [
+    'SYNCTHING_API_BASE_URI',
+    'ST_CONFIG_LOCATIONS',
+    'DEFAULT_ST_CONFIG_LOCATION',
+    'get_common_argument_spec',
+    'get_key_from_filesystem',
+    'get_config',
+    'get_status',
+    'get_self_id',
+    'post_config',
+]
+
+SYNCTHING_API_BASE_URI = "/rest"
+_SYSTEM = platform.system()
+if _SYSTEM == 'Windows':
+    _ST_CONFIG_LOCATIONS = ['%localappdata%/Syncthing/config.xml']
+elif _SYSTEM == 'Darwin':
+    _ST_CONFIG_LOCATIONS = [
+        '$HOME/Library/Application Support/Syncthing/config.xml',
+    ]
+else:
+    # Syncthing >= 1.27 defaults to the state directory, but keeps using the
+    # former configuration directory whenever it exists
+    _ST_CONFIG_LOCATIONS = [
+        os.path.join(os.environ.get('XDG_CONFIG_HOME') or '$HOME/.config',
+                     'syncthing', 'config.xml'),
+        os.path.join(os.environ.get('XDG_STATE_HOME') or '$HOME/.local/state',
+                     'syncthing', 'config.xml'),
+    ]
+# Resolved once, the environment does not change during a run
+ST_CONFIG_LOCATIONS = [os.path.expandvars(p) for p in _ST_CONFIG_LOCATIONS]
+# The first location found, else the former default one
+DEFAULT_ST_CONFIG_LOCATION = next(
+    (p for p in ST_CONFIG_LOCATIONS if os.path.isfile(p)),
+    ST_CONFIG_LOCATIONS[0],
+)
+
+CACHE_DIR = os.path.expanduser('~/.cache/ansible_syncthing')
+# Replaces an existing file on every platform; there is no os.replace on
+# Python 2, whose os.rename does on POSIX
+_replace = getattr(os, 'replace', os.rename)
+
+# Lazily created by get_session()
+_SESSION = None
+# Options of url_argument_spec() only fetch_url knows how to honour
+_FETCH_URL_AUTH_PARAMS = (
+    'url_username',
+    'url_password',
+    'force_basic_auth',
+    'client_cert',
+    'client_key',
+    'use_gssapi',
+)
+# ID of the Syncthing device, as told by the headers of the last response
+_SELF_ID = None
+# Lazily built by make_headers()
+_BASE_URL = None
+_HEADERS = None
+
+
+# Get the URL of a resource and the headers to call it with. The base URL and
+# headers are only built once: the host and API key do not change during a run
+def make_headers(module, resource):
+    global _BASE_URL, _HEADERS
+    if _BASE_URL is None:
+        _BASE_URL = module.params['host'] + SYNCTHING_API_BASE_URI + '/'
+        _HEADERS = {'X-Api-Key': module.params['api_key']}
+    # Copied, callers may add their own headers
+    return _BASE_URL + resource, dict(_HEADERS)
+
+# Read the API key from config.xml, unless the cache is enabled and the file
+# did not change since the last time it was read
+def get_key_from_filesystem(module):
+    stconfigfile = module.params['config_file'] or DEFAULT_ST_CONFIG_LOCATION
+    if not module.params['cache_ttl']:
+        return parse_key_from_filesystem(module, stconfigfile)
+
+    stamp = get_config_file_stamp(module)
+    key_cache_path = get_key_cache_path(stconfigfile)
+    if stamp is not None:
+        api_key = load_key_cache(key_cache_path, stamp)
+        if api_key is not None:
+            return api_key
+    api_key = parse_key_from_filesystem(module, stconfigfile)
+    write_cache_file(key_cache_path, dict(stamp=stamp, api_key=api_key))
+    return api_key
+
+def parse_key_from_filesystem(module, stconfigfile):
+    try:
+        # Only gui/apikey is needed: stream the configuration, releasing the
+        # elements parsed on the way, and stop as soon as it is found.
+        in_gui = False
+        for event, elem in iterparse(stconfigfile, events=('start', 'end')):
+            if elem.tag == 'gui':
+                if event == 'end':
+                    break
+                in_gui = True
+            elif event == 'end':
+                if in_gui and elem.tag == 'apikey':
+                    return elem.text
+                elem.clear()
+    except ParseError as e:
+        module.fail_json(msg="Auto-configuration failed, could not parse {}:"
+                             " {}. Please specify the API key manually."
+                             .format(stconfigfile, e))
+    except (IOError, OSError) as e:
+        module.fail_json(msg="Auto-configuration failed, could not read {}:"
+                             " {}. Please specify the API key manually."
+                             .format(stconfigfile, e))
+    module.fail_json(msg="Auto-configuration failed, no API key found in {}."
+                         " Please specify the API key manually."
+                         .format(stconfigfile))
+
+# Path of the cache of the targeted Syncthing instance
+def get_cache_path(module):
+    key = '{}\n{}'.format(module.params['host'], module.params['api_key'])
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, '{}.json'.format(digest))
+
+# Path of the cache of the API key read from the given config.xml
+def get_key_cache_path(stconfigfile):
+    digest = hashlib.sha256(stconfigfile.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, 'apikey-{}.json'.format(digest))
+
+# Load the cached API key, if config.xml still has the same stamp
+def load_key_cache(key_cache_path, stamp):
+    try:
+        with open(key_cache_path, 'rb') as cache:
+            cached = _loads(cache.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if cached.get('stamp') != stamp:
+        return None
+    return cached.get('api_key')
+
+# Load the cached values (`config`, `myID`), if any and still fresh
+def load_cache(module):
+    if not module.params['cache_ttl']:
+        return None
+    try:
+        with open(get_cache_path(module), 'rb') as cache:
+            cached = _loads(cache.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if time.time() - cached['time'] > module.params['cache_ttl']:
+        return None
+    return cached
+
+# Store the given values into the cache, along with the fresh ones already
+# cached, replacing it atomically
+def store_cache(module, **values):
+    if not module.params['cache_ttl']:
+        return
+    cached = load_cache(module) or {}
+    cached.update(values)
+    cached['time'] = time.time()
+    write_cache_file(get_cache_path(module), cached)
+
+# Write the given values to a cache file, replacing it atomically
+def write_cache_file(path, values):
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, 0o700)
+        # The cached values hold secrets: mkstemp creates it private
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+    except (IOError, OSError):
+        # Caching is only an optimization, never fail because of it
+        return
+    try:
+        with os.fdopen(fd, 'wb') as cache:
+            cache.write(_dumps(values))
+        _replace(tmp_path, path)
+    except (IOError, OSError):
+        # Do not leave the secrets behind
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+# Stamp of the Syncthing config.xml, if it is readable: Syncthing rewrites
+# it on every configuration change, and offers no ETag to tell us instead
+def get_config_file_stamp(module):
+    stconfigfile = module.params['config_file'] or DEFAULT_ST_CONFIG_LOCATION
+    try:
+        stat = os.stat(stconfigfile)
+    except OSError:
+        return None
+    # No st_mtime_ns on Python 2
+    mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+    return [mtime_ns, stat.st_size]
+
+# Drop the cached values, if any
+def invalidate_cache(module):
+    try:
+        os.remove(get_cache_path(module))
+    except OSError:
+        pass
+
+# Get the HTTP session shared by all the calls of this run, so that they
+# reuse the same keep-alive connection.
+def get_session(module):
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        _SESSION.verify = module.params['validate_certs']
+        _SESSION.trust_env = module.params['use_proxy']
+        _SESSION.headers['User-Agent'] = module.params['http_agent']
+        # A run only ever talks to a single Syncthing instance. Retry the
+        # calls failing to connect, such as while Syncthing restarts (no
+        # request was sent yet, so this is safe for POSTs too), and the GETs
+        # failing to read the response.
+        retries = Retry(total=2, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                              max_retries=retries)
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+# Whether the requests session can make the calls: it does not implement the
+# authentication options of fetch_url
+def can_use_session(module):
+    return HAS_REQUESTS and not any(
+        module.params.get(name) for name in _FETCH_URL_AUTH_PARAMS
+    )
+
+# Call the Syncthing REST API, with the same return values as fetch_url.
+# Goes through the shared session when requests is available, and none of
+# the authentication options of fetch_url are used.
+def open_rest_api(module, url, headers, method, data=None):
+    timeout = module.params['timeout']
+    if not can_use_session(module):
+        return fetch_url(
+            module, url, data=data, headers=headers,
+            method=method, timeout=timeout)
+
+    try:
+        resp = get_session(module).request(
+            method, url, data=data, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        return None, {'status': -1, 'msg': str(e), 'url': url}
+
+    info = dict((k.lower(), v) for k, v in resp.headers.items())
+    info.update(status=resp.status_code, msg=resp.reason, url=resp.url)
+    return BytesIO(resp.content), info
+
+def get_data_from_rest_api(module, resource):
+    global _SELF_ID
+    url, headers = make_headers(module, resource)
+    resp, info = open_rest_api(module, url, headers, 'GET')
+
+    status = info.get('status') if info else None
+    if status != 200:
+        invalidate_cache(module)
+        module.fail_json(msg='Error occured while calling host',
+                         changed=False, response=info)
+
+    try:
+        content = resp.read()
+    except AttributeError:
+        module.fail_json(msg='Error occured while reading response',
+                         changed=False, content=info.pop('body', ''),
+                         response=str(info))
+
+    _SELF_ID = info.get('x-syncthing-id', _SELF_ID)
+    return _loads(content)
+
+# Fetch Syncthing configuration, unless cached and config.xml unchanged since
+def get_config(module):
+    # Taken before the GET: were config.xml saved in-between, the fetched
+    # configuration must not be cached as matching the newer file
+    stamp = get_config_file_stamp(module)
+    cached = load_cache(module)
+    if cached is not None and 'config' in cached:
+        if cached.get('config_stamp') == stamp:
+            return cached['config']
+    config = get_data_from_rest_api(module, 'system/config')
+    store_cache(module, config=config, config_stamp=stamp)
+    return config
+
+# Fetch Syncthing status
+def get_status(module):
+    return get_data_from_rest_api(module, 'system/status')
+
+# Get the ID of the Syncthing device itself, unless cached: it never changes
+# for a given instance
+def get_self_id(module):
+    cached = load_cache(module)
+    if cached is not None and 'myID' in cached:
+        return cached['myID']
+    # Syncthing tells it along with any response, else ask for it
+    self_id = _SELF_ID or get_status(module)['myID']
+    store_cache(module, myID=self_id)
+    return self_id
+
+# Post the new configuration to Syncthing API
+def post_config(module, config, result):
+    url, headers = make_headers(module, 'system/config')
+    headers['Content-Type'] = 'application/json'
+
+    resp, info = open_rest_api(module, url, headers, 'POST', data=_dumps(config))
+
+    if not info or info['status'] != 200:
+        invalidate_cache(module)
+        result['response'] = str(info)
+        module.fail_json(msg='Error occured while posting new config', **result)
+
+    # Syncthing saves config.xml after this POST, but possibly other changes
+    # too by the time it is stat'ed: leave the stamp out, so that the posted
+    # configuration is only reused when config.xml cannot be read
+    store_cache(module, config=config, config_stamp=None)
+
+# Get the arguments common to all the Syncthing modules
+def get_common_argument_spec():
+    argument_spec = url_argument_spec()
+    argument_spec.update(dict(
+        host=dict(type='str', default='http://127.0.0.1:8384',
+                  fallback=(env_fallback, ['SYNCTHING_HOST'])),
+        api_key=dict(type='str', required=False, no_log=True,
+                     fallback=(env_fallback, ['SYNCTHING_API_KEY'])),
+        config_file=dict(type='path', required=False),
+        timeout=dict(type='int', default=30),
+        cache_ttl=dict(type='int', default=0),
+    ))
+    return argument_spec